@@ -1,17 +1,34 @@
 #!/usr/bin/env python3
+import glob
 import os
 import re
+import shutil
 import subprocess
 import sys
+import tomllib
 import argparse
+import asyncio
+import functools
+import importlib.metadata
 
-RED = "\033[91m"
-GREEN = "\033[92m"
-YELLOW = "\033[93m"
-RESET = "\033[0m"
+USE_COLOR = sys.stdout.isatty()
+
+RED = "\033[91m" if USE_COLOR else ""
+GREEN = "\033[92m" if USE_COLOR else ""
+YELLOW = "\033[93m" if USE_COLOR else ""
+RESET = "\033[0m" if USE_COLOR else ""
+
+REQUIREMENT_RE = re.compile(r"([A-Za-z0-9._-]+)(==([\w.+-]+))?")
+NAME_SEPARATOR_RE = re.compile(r"[-_.]+")
+README_RE = re.compile(r'(?m)^[ \t]*readme[ \t]*=[ \t]*"README\.md".*\n?')
+
+SUBPROCESS_OPTIONS = {"close_fds": os.name != "posix"}
+MAX_PARALLEL_PROBES = 10
+FREEZE_EXCLUDED = {"pip", "setuptools", "wheel", "distribute"}
 
 already_added = set()
 successfully_added = []
+declared_dependencies = None
 
 def print_error(message):
     print(f"{RED}[ERROR]{RESET} {message}")
@@ -22,21 +39,31 @@ def print_info(message):
 def print_warning(message):
     print(f"{YELLOW}[WARNING]{RESET} {message}")
 
+def canonicalize_name(name):
+    return NAME_SEPARATOR_RE.sub("-", name).lower()
+
 def check_poetry_installed():
-    try:
-        subprocess.check_call(["poetry", "--version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    if shutil.which("poetry") is None:
         print_error("Poetry is not installed or not found. Please install Poetry and rerun the script.")
         sys.exit(1)
 
-def create_pyproject_if_missing():
+def create_pyproject_if_missing(assume_yes=False, no_init=False):
     if not os.path.exists("pyproject.toml"):
-        answer = input("pyproject.toml not found. Create one with 'poetry init'? [yes/no]: ").strip().lower()
+        if no_init:
+            print_error("pyproject.toml not found and --no-init was given. Please create a pyproject.toml file first.")
+            sys.exit(1)
+        if assume_yes:
+            answer = "yes"
+        elif sys.stdin.isatty():
+            answer = input("pyproject.toml not found. Create one with 'poetry init'? [yes/no]: ").strip().lower()
+        else:
+            print_error("pyproject.toml not found and stdin is not interactive. Rerun with --yes to create one.")
+            sys.exit(1)
         if answer == "yes":
             try:
-                subprocess.check_call(["poetry", "init", "--no-interaction"])
+                subprocess.check_call(["poetry", "init", "--no-interaction"], **SUBPROCESS_OPTIONS)
                 print_info("pyproject.toml created successfully.")
-                subprocess.check_call(["poetry", "lock"])
+                subprocess.check_call(["poetry", "lock"], **SUBPROCESS_OPTIONS)
             except subprocess.CalledProcessError as e:
                 print_error(f"Error during pyproject.toml creation: {e}")
                 sys.exit(1)
@@ -44,17 +71,33 @@ def create_pyproject_if_missing():
             print_error("Exiting script. Please create a pyproject.toml file first.")
             sys.exit(1)
 
-def ensure_pipreqs_installed():
+def pipreqs_installed():
+    if shutil.which("pipreqs") is not None:
+        return True
     try:
-        subprocess.check_call(
-            ["poetry", "run", "pipreqs", "--version"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
+        venv = subprocess.check_output(
+            ["poetry", "env", "info", "--path"],
+            stderr=subprocess.DEVNULL,
+            text=True,
+            **SUBPROCESS_OPTIONS
+        ).strip()
     except subprocess.CalledProcessError:
+        return False
+    if not venv or not os.path.isdir(venv):
+        return False
+    patterns = [
+        os.path.join(venv, "lib", "python*", "site-packages", "pipreqs-*.dist-info"),
+        os.path.join(venv, "Lib", "site-packages", "pipreqs-*.dist-info"),
+        os.path.join(venv, "bin", "pipreqs"),
+        os.path.join(venv, "Scripts", "pipreqs.exe"),
+    ]
+    return any(glob.glob(pattern) for pattern in patterns)
+
+def ensure_pipreqs_installed():
+    if not pipreqs_installed():
         print_info("pipreqs not found in the Poetry environment. Installing pipreqs with adjusted Python marker.")
         try:
-            subprocess.check_call(["poetry", "add", "pipreqs@^0.5.0", "--python", ">=3.12,<3.13"])
+            subprocess.check_call(["poetry", "add", "pipreqs@^0.5.0", "--python", ">=3.12,<3.13"], **SUBPROCESS_OPTIONS)
         except subprocess.CalledProcessError as e:
             print_error(f"Failed to install pipreqs: {e}")
             sys.exit(1)
@@ -65,7 +108,7 @@ def generate_requirements_with_pipreqs(overwrite=False):
         cmd.append("--force")
     try:
         print_info("Running pipreqs to generate requirements.txt...")
-        subprocess.check_call(cmd)
+        subprocess.check_call(cmd, **SUBPROCESS_OPTIONS)
         print_info("requirements.txt generated successfully.")
     except subprocess.CalledProcessError as e:
         print_error(f"pipreqs failed: {e}")
@@ -74,89 +117,191 @@ def generate_requirements_with_pipreqs(overwrite=False):
 def get_venv_packages():
     if (hasattr(sys, 'real_prefix') or 
         (hasattr(sys, 'base_prefix') and sys.base_prefix != sys.prefix)):
-        try:
-            result = subprocess.check_output([sys.executable, "-m", "pip", "freeze"], text=True)
-            packages = {}
-            for line in result.strip().split('\n'):
-                if '==' in line:
-                    pkg, ver = line.split('==')
-                    packages[pkg.lower()] = ver
-                elif '@' in line:
-                    pkg = line.split('@')[0].strip().lower()
-                    packages[pkg] = None
-            return packages
-        except subprocess.CalledProcessError as e:
-            print_warning(f"Could not retrieve packages from the active venv: {e}")
-            return {}
+        packages = {}
+        for dist in importlib.metadata.distributions():
+            name = dist.metadata["Name"]
+            if not name:
+                continue
+            name = canonicalize_name(name)
+            if name in FREEZE_EXCLUDED or name in packages:
+                continue
+            if dist.read_text("direct_url.json") is not None:
+                packages[name] = None
+            else:
+                packages[name] = dist.version
+        return packages
     else:
         print_info("No Python virtual environment detected. Skipping venv package addition.")
         return {}
 
-def add_library_to_poetry(library, version, overwrite_existing=False):
-    if library in already_added:
-        return
+def load_declared_dependencies():
+    global declared_dependencies
+    if declared_dependencies is None:
+        with open("pyproject.toml", "rb") as file:
+            pyproject = tomllib.load(file)
+        poetry = pyproject.get("tool", {}).get("poetry", {})
+        names = set(poetry.get("dependencies", {}))
+        names.update(poetry.get("dev-dependencies", {}))
+        for group in poetry.get("group", {}).values():
+            names.update(group.get("dependencies", {}))
+        for requirement in pyproject.get("project", {}).get("dependencies", []):
+            match = REQUIREMENT_RE.match(requirement.strip())
+            if match:
+                names.add(match.group(1))
+        names.discard("python")
+        declared_dependencies = {canonicalize_name(name) for name in names}
+    return declared_dependencies
+
+def dependency_exists(library):
+    return library in load_declared_dependencies()
+
+def record_added(library, dependency_spec):
+    successfully_added.append(dependency_spec)
+    if declared_dependencies is not None:
+        declared_dependencies.add(library)
+
+def format_dependency_spec(library, version):
+    if version and version != "*":
+        return f"{library}=={version}"
+    return library
+
+async def probe_dependency(library, version, semaphore):
+    candidates = [format_dependency_spec(library, version)]
+    if candidates[0] != library:
+        candidates.append(library)
+    for spec in candidates:
+        async with semaphore:
+            process = await asyncio.create_subprocess_exec(
+                "poetry", "add", "--dry-run", spec,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+                **SUBPROCESS_OPTIONS
+            )
+            returncode = await process.wait()
+        if returncode == 0:
+            return spec
+    return None
+
+async def probe_dependencies(failed):
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_PROBES)
+    return await asyncio.gather(*(probe_dependency(library, version, semaphore) for library, version in failed.items()))
+
+def add_library_to_poetry(library, dependency_spec):
     try:
-        current_deps = subprocess.check_output(["poetry", "show", "--tree"]).decode("utf-8").lower()
-        if library.lower() in current_deps and not overwrite_existing:
-            print_info(f"{library} already exists in pyproject.toml. Skipping.")
-            return
-        if version and version != "*":
-            dependency_spec = f"{library}=={version}"
+        subprocess.check_call(["poetry", "add", dependency_spec], **SUBPROCESS_OPTIONS)
+        print_info(f"Added {dependency_spec} to Poetry.")
+        record_added(library, dependency_spec)
+    except subprocess.CalledProcessError:
+        if dependency_spec != library:
+            print_warning(f"Failed to add {dependency_spec} with version constraint. Trying without version constraint.")
+            try:
+                subprocess.check_call(["poetry", "add", library], **SUBPROCESS_OPTIONS)
+                print_info(f"Added {library} (without version constraint) to Poetry.")
+                record_added(library, library)
+            except subprocess.CalledProcessError as inner_error:
+                print_warning(f"Skipping {library} due to build errors: {inner_error}")
         else:
-            dependency_spec = library
+            print_warning(f"Skipping {library} due to unresolved installation issues.")
+
+def retry_failed_dependencies(failed):
+    print_warning("Batch add failed. Checking each dependency individually.")
+    resolved = asyncio.run(probe_dependencies(failed))
+    specs = {}
+    for (library, version), spec in zip(failed.items(), resolved):
+        if spec is None:
+            print_warning(f"Skipping {library} due to unresolved installation issues.")
+            continue
+        if spec != format_dependency_spec(library, version):
+            print_warning(f"Failed to resolve {library}=={version}. Adding {library} without version constraint.")
+        specs[library] = spec
+    if not specs:
+        return
+    original_specs = {library: format_dependency_spec(library, version) for library, version in failed.items()}
+    if specs != original_specs:
         try:
-            subprocess.check_call(["poetry", "add", dependency_spec])
-            print_info(f"Added {dependency_spec} to Poetry.")
-            successfully_added.append(dependency_spec)
+            subprocess.check_call(["poetry", "add", *specs.values()], **SUBPROCESS_OPTIONS)
+            for library, spec in specs.items():
+                print_info(f"Added {spec} to Poetry.")
+                record_added(library, spec)
+            return
         except subprocess.CalledProcessError:
+            pass
+    print_warning("Adding the remaining dependencies one at a time.")
+    for library, spec in specs.items():
+        add_library_to_poetry(library, spec)
+
+def add_libraries_to_poetry(libraries, overwrite_existing=False):
+    pinned = {}
+    unpinned = {}
+    try:
+        for library, version in libraries:
+            if library in already_added or library in pinned or library in unpinned:
+                continue
+            if not overwrite_existing and dependency_exists(library):
+                print_info(f"{library} already exists in pyproject.toml. Skipping.")
+                continue
             if version and version != "*":
-                print_warning(f"Failed to add {dependency_spec} with version constraint. Trying without version constraint.")
-                try:
-                    subprocess.check_call(["poetry", "add", library])
-                    print_info(f"Added {library} (without version constraint) to Poetry.")
-                    successfully_added.append(library)
-                except subprocess.CalledProcessError as inner_error:
-                    print_warning(f"Skipping {library} due to build errors: {inner_error}")
+                pinned[library] = version
             else:
-                print_warning(f"Skipping {library} due to unresolved installation issues.")
-        already_added.add(library)
-    except subprocess.CalledProcessError as e:
-        print_error(f"Error adding {library}: {e}")
+                unpinned[library] = version
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        print_error(f"Error reading dependencies from pyproject.toml: {e}")
+        return
+    for bucket in (pinned, unpinned):
+        if not bucket:
+            continue
+        specs = {library: format_dependency_spec(library, version) for library, version in bucket.items()}
+        try:
+            subprocess.check_call(["poetry", "add", *specs.values()], **SUBPROCESS_OPTIONS)
+            for library, spec in specs.items():
+                print_info(f"Added {spec} to Poetry.")
+                record_added(library, spec)
+        except subprocess.CalledProcessError:
+            retry_failed_dependencies(bucket)
+        already_added.update(bucket)
 
-def parse_requirements_and_add(overwrite_existing=False):
-    if not os.path.exists("requirements.txt"):
-        print_error("requirements.txt not found.")
+@functools.lru_cache(maxsize=None)
+def read_requirements_file(path, mtime):
+    libraries = []
+    unparsed = []
+    with open(path, "r") as req_file:
+        data = req_file.read()
+    for line in data.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        match = REQUIREMENT_RE.match(line)
+        if match:
+            library = canonicalize_name(match.group(1))
+            version = match.group(3) if match.group(3) else "*"
+            libraries.append((library, version))
+        else:
+            unparsed.append(line)
+    return tuple(libraries), tuple(unparsed)
+
+def parse_requirements(path="requirements.txt"):
+    if not os.path.exists(path):
+        print_error(f"{path} not found.")
         sys.exit(1)
-    with open("requirements.txt", "r") as req_file:
-        for line in req_file:
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            match = re.match(r"([A-Za-z0-9._-]+)(==([\w.+-]+))?", line)
-            if match:
-                library = match.group(1)
-                version = match.group(3) if match.group(3) else "*"
-                add_library_to_poetry(library, version, overwrite_existing)
-            else:
-                print_warning(f"Could not parse the requirement line: {line}")
+    libraries, unparsed = read_requirements_file(path, os.path.getmtime(path))
+    for line in unparsed:
+        print_warning(f"Could not parse the requirement line: {line}")
+    return list(libraries)
 
-def add_venv_packages_to_poetry(overwrite_existing=False):
+def collect_venv_packages():
     venv_packages = get_venv_packages()
     if not venv_packages:
-        return
-    print_info("Adding packages from the active Python virtual environment to Poetry...")
-    for library, version in venv_packages.items():
-        if library not in already_added:
-            add_library_to_poetry(library, version if version else "*", overwrite_existing)
+        return []
+    print_info("Including packages from the active Python virtual environment...")
+    return [(library, version if version else "*") for library, version in venv_packages.items()]
 
 def clean_up_pyproject():
     if os.path.exists("pyproject.toml"):
         with open("pyproject.toml", "r") as file:
-            lines = file.readlines()
+            data = file.read()
+        data = README_RE.sub("", data)
         with open("pyproject.toml", "w") as file:
-            for line in lines:
-                if not re.match(r'\s*readme\s*=\s*"README\.md"', line):
-                    file.write(line)
+            file.write(data)
         print_info('Removed `readme = "README.md"` from pyproject.toml.')
 
 def main():
@@ -164,13 +309,16 @@ def main():
         description="Add dependencies to Poetry using pipreqs and Python venv for requirements generation."
     )
     parser.add_argument("--overwrite", action="store_true", help="Overwrite existing dependencies in pyproject.toml if they already exist.")
+    init_group = parser.add_mutually_exclusive_group()
+    init_group.add_argument("--yes", action="store_true", help="Create pyproject.toml with 'poetry init' without prompting if it is missing.")
+    init_group.add_argument("--no-init", action="store_true", help="Exit with an error instead of prompting if pyproject.toml is missing.")
     args = parser.parse_args()
     check_poetry_installed()
-    create_pyproject_if_missing()
+    create_pyproject_if_missing(assume_yes=args.yes, no_init=args.no_init)
     ensure_pipreqs_installed()
     generate_requirements_with_pipreqs(overwrite=args.overwrite)
-    parse_requirements_and_add(overwrite_existing=args.overwrite)
-    add_venv_packages_to_poetry(overwrite_existing=args.overwrite)
+    libraries = parse_requirements() + collect_venv_packages()
+    add_libraries_to_poetry(libraries, overwrite_existing=args.overwrite)
     clean_up_pyproject()
     if successfully_added:
         print_info("Done")